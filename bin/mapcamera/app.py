@@ -1,17 +1,36 @@
 import os
+import re
+import sys
+import csv
+import io
+import glob
+import hashlib
 import json
+import mmap
 import time
+import fcntl
+import tempfile
+import logging
 import secrets
-from typing import Any, Dict, List, Optional
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_MODULE_STARTED = time.perf_counter()
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, Form, Header, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel, Field
 import pymysql
 
+_IMPORTS_DONE = time.perf_counter()
 load_dotenv("/home/retail/py/env/asin-to-remember.env")
+_DOTENV_DONE = time.perf_counter()
 
 API_KEY = os.environ.get("MC_LOG_API_KEY", "golden")
 MYSQL_HOST = os.environ.get("MC_MYSQL_HOST", "192.168.1.1")
@@ -23,10 +42,65 @@ JANCODE_MST_PATH = os.environ.get("MC_JANCODE_MST_PATH", "/home/retail/mst/map.j
 ASIN_AUTH_USER = os.environ.get("ASIN_TO_REMEMBER_USER")
 ASIN_AUTH_PASS = os.environ.get("ASIN_TO_REMEMBER_PASS")
 GOOGLE_SEARCH_CACHE_FLG = os.environ.get("GOOGLE_SEARCH_CACHE_FLG", "")
+CRAWL_DEFAULT_DELAY_MS = int(os.environ.get("MC_CRAWL_DEFAULT_DELAY_MS", "2000"))
+CRAWL_MIN_DELAY_MS = int(os.environ.get("MC_CRAWL_MIN_DELAY_MS", "1000"))
+CRAWL_MAX_DELAY_MS = int(os.environ.get("MC_CRAWL_MAX_DELAY_MS", "300000"))
+CRAWL_POLLS_PER_CHANGE = float(os.environ.get("MC_CRAWL_POLLS_PER_CHANGE", "4"))
+CRAWL_EWMA_ALPHA = float(os.environ.get("MC_CRAWL_EWMA_ALPHA", "0.3"))
+CRAWL_MAX_TRACKED_URLS = int(os.environ.get("MC_CRAWL_MAX_TRACKED_URLS", "10000"))
+CRAWL_STATS_MAX_IDLE_S = float(os.environ.get("MC_CRAWL_STATS_MAX_IDLE_S", "86400"))
+TRACE_SPANS_ENABLED = os.environ.get("MC_TRACE_SPANS", "") in ("1", "true", "yes")
+PROFILE_MAX_SECONDS = int(os.environ.get("MC_PROFILE_MAX_SECONDS", "60"))
+TRACE_LOG_LEVEL = os.environ.get("MC_TRACE_LOG_LEVEL", "INFO").upper()
+ASIN_BULK_CHUNK_SIZE = int(os.environ.get("MC_ASIN_BULK_CHUNK_SIZE", "500"))
+ASIN_BULK_MAX_ITEMS = int(os.environ.get("MC_ASIN_BULK_MAX_ITEMS", "50000"))
+SHARED_DIR = os.environ.get("MC_SHARED_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "mapcamera"
+)
+SHARED_CACHE_TTL_S = float(os.environ.get("MC_SHARED_CACHE_TTL_S", "30"))
+WORKERS = int(os.environ.get("MC_WORKERS", "1"))
+SLOW_QUERY_MS = float(os.environ.get("MC_SLOW_QUERY_MS", "500"))
+SLOW_QUERY_BUFFER_SIZE = int(os.environ.get("MC_SLOW_QUERY_BUFFER_SIZE", "100"))
+SLOW_QUERY_CAPTURE_INTERVAL_S = float(os.environ.get("MC_SLOW_QUERY_CAPTURE_INTERVAL_S", "60"))
+READY_DB_CHECK_TTL_S = float(os.environ.get("MC_READY_DB_CHECK_TTL_S", "5"))
+MYSQL_REPLICA_HOST = os.environ.get("MC_MYSQL_REPLICA_HOST", "")
+MYSQL_REPLICA_PORT = int(os.environ.get("MC_MYSQL_REPLICA_PORT", str(MYSQL_PORT)))
+MYSQL_REPLICA_USER = os.environ.get("MC_MYSQL_REPLICA_USER", MYSQL_USER)
+MYSQL_REPLICA_PASS = os.environ.get("MC_MYSQL_REPLICA_PASS", MYSQL_PASS)
+REPLICA_POOL_SIZE = int(os.environ.get("MC_REPLICA_POOL_SIZE", "4"))
+REPLICA_POOL_RECYCLE_S = float(os.environ.get("MC_REPLICA_POOL_RECYCLE_S", "300"))
+REPLICA_MAX_LAG_S = float(os.environ.get("MC_REPLICA_MAX_LAG_S", "5"))
+REPLICA_LAG_CHECK_TTL_S = float(os.environ.get("MC_REPLICA_LAG_CHECK_TTL_S", "5"))
+REPLICA_RETRY_AFTER_S = float(os.environ.get("MC_REPLICA_RETRY_AFTER_S", "30"))
+# 遅延の取得に使う SQL（1行目の1列目 = 遅延秒）。未設定なら SHOW REPLICA STATUS（REPLICATION CLIENT 権限が必要）
+REPLICA_LAG_QUERY = os.environ.get("MC_REPLICA_LAG_QUERY", "")
+# レプリケーション未設定のインスタンス（SHOW REPLICA STATUS が空）を遅延 0 とみなす。ローカル検証専用
+REPLICA_ASSUME_NO_LAG = os.environ.get("MC_REPLICA_ASSUME_NO_LAG", "") in ("1", "true", "yes")
+
+def _json_line_logger(name: str, level: str) -> logging.Logger:
+    """
+    JSON 1行をそのまま stderr に出すロガー。uvicorn は自分のロガーしか設定しないので、ここで handler と level を付ける。
+    """
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+trace_logger = _json_line_logger("mapcamera.trace", TRACE_LOG_LEVEL)
+startup_logger = _json_line_logger("mapcamera.startup", "INFO")
 
 basic_security = HTTPBasic()
 
-app = FastAPI(title="MapCamera Log Ingest")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    start_warm_up()
+    yield
+
+app = FastAPI(title="MapCamera Log Ingest", lifespan=lifespan)
 
 @app.get("/")
 def root():
@@ -225,6 +299,177 @@ def render_google_search_cache_form(current_value: str, message: Optional[str] =
 </html>
 """
 
+_SQL_WS_RE = re.compile(r"\s+")
+_SQL_VALUE_GROUPS_RE = re.compile(r"(\(%s(?:, ?%s)*\))(?:, ?\(%s(?:, ?%s)*\))+")
+_SQL_ROW_GROUP_RE = re.compile(r"(?<!\w)\(\s*%s")
+_SQL_DML_RE = re.compile(r"^\s*(INSERT|REPLACE|UPDATE|DELETE)\b", re.IGNORECASE)
+LOCK_ERROR_CODES = (1205, 1213)  # Lock wait timeout / Deadlock
+
+def sql_template(query: str) -> str:
+    """空白を詰め、複数行 VALUES の繰り返しを1組にまとめた文（ステートメント単位の集計キー）。"""
+    q = _SQL_WS_RE.sub(" ", query).strip()
+    return _SQL_VALUE_GROUPS_RE.sub(r"\1,...", q)
+
+def sql_rows_sent(query: str, param_rows: int) -> Optional[int]:
+    """
+    DML が書き込もうとした行数。INSERT/REPLACE は VALUES の組数 × パラメータ行数、
+    UPDATE/DELETE はパラメータ行数（1回の実行 = 1行分の指定）。DML 以外は None。
+    """
+    match = _SQL_DML_RE.match(query)
+    if not match:
+        return None
+    if match.group(1).upper() in ("INSERT", "REPLACE"):
+        return max(1, len(_SQL_ROW_GROUP_RE.findall(query))) * param_rows
+    return param_rows
+
+class SqlStats:
+    """
+    テンプレートごとの実行回数・所要時間・送信行数/影響行数（DML）・取得行数（DML 以外）・エラー数と、
+    遅いクエリのリングバッファ。
+    """
+    def __init__(self, slow_buffer_size: int):
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self.slow: deque = deque(maxlen=slow_buffer_size)
+        self._last_capture: Dict[str, float] = {}
+
+    def _entry(self, template: str) -> Dict[str, float]:
+        entry = self.stats.get(template)
+        if entry is None:
+            entry = {
+                "calls": 0, "errors": 0, "lock_errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "rows_sent": 0, "rows_affected": 0, "rows_returned": 0, "slow_calls": 0,
+            }
+            self.stats[template] = entry
+        return entry
+
+    def record(self, template: str, elapsed_ms: float, rows_sent: Optional[int], rowcount: int) -> None:
+        """rows_sent が None（DML 以外）のときは rowcount を取得行数として数える。"""
+        with self._lock:
+            entry = self._entry(template)
+            entry["calls"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            if rows_sent is None:
+                entry["rows_returned"] += max(0, rowcount)
+            else:
+                entry["rows_sent"] += rows_sent
+                entry["rows_affected"] += max(0, rowcount)
+
+    def note_slow(self, template: str) -> bool:
+        """遅い実行を数え、EXPLAIN 等を取得してよいか（テンプレートごとに SLOW_QUERY_CAPTURE_INTERVAL_S に1回）を返す。"""
+        now = time.monotonic()
+        with self._lock:
+            self._entry(template)["slow_calls"] += 1
+            last = self._last_capture.get(template)
+            if last is not None and now - last < SLOW_QUERY_CAPTURE_INTERVAL_S:
+                return False
+            self._last_capture[template] = now
+            return True
+
+    def record_error(self, template: str, elapsed_ms: float, error: Exception) -> None:
+        code = error.args[0] if error.args else None
+        with self._lock:
+            entry = self._entry(template)
+            entry["calls"] += 1
+            entry["errors"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            if code in LOCK_ERROR_CODES:
+                entry["lock_errors"] += 1
+
+    def add_slow(self, item: Dict[str, Any]) -> None:
+        with self._lock:
+            self.slow.append(item)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            statements = []
+            for template, entry in self.stats.items():
+                row = dict(entry)
+                row["sql"] = template if len(template) <= 300 else template[:300] + "..."
+                row["avg_ms"] = round(entry["total_ms"] / entry["calls"], 3) if entry["calls"] else 0
+                row["total_ms"] = round(entry["total_ms"], 3)
+                row["max_ms"] = round(entry["max_ms"], 3)
+                statements.append(row)
+            slow = list(self.slow)
+        statements.sort(key=lambda r: r["total_ms"], reverse=True)
+        return {
+            "pid": os.getpid(),
+            "slow_query_ms": SLOW_QUERY_MS,
+            "slow_capture_interval_s": SLOW_QUERY_CAPTURE_INTERVAL_S,
+            "statements": statements,
+            "slow": slow,
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stats.clear()
+            self.slow.clear()
+            self._last_capture.clear()
+
+sql_stats = SqlStats(SLOW_QUERY_BUFFER_SIZE)
+
+class InstrumentedCursor(pymysql.cursors.DictCursor):
+    """
+    execute / executemany の所要時間・送信行数・影響行数を sql_stats に記録する DictCursor。
+    SLOW_QUERY_MS を超えた文は別カーソルで SHOW WARNINGS と EXPLAIN を取得してリングバッファへ残す
+    （リクエスト内で追加のクエリになるので、テンプレートごとに SLOW_QUERY_CAPTURE_INTERVAL_S に1回まで）。
+    """
+    _mc_active = False
+
+    def execute(self, query, args=None):
+        if self._mc_active:
+            # executemany の内部呼び出しは外側でまとめて計測する
+            return super().execute(query, args)
+        return self._instrumented(super().execute, query, args, False)
+
+    def executemany(self, query, args):
+        return self._instrumented(super().executemany, query, args, True)
+
+    def _instrumented(self, fn, query, args, many: bool):
+        template = sql_template(query)
+        self._mc_active = True
+        started = time.perf_counter()
+        try:
+            result = fn(query, args)
+        except pymysql.err.MySQLError as e:
+            sql_stats.record_error(template, (time.perf_counter() - started) * 1000, e)
+            raise
+        finally:
+            self._mc_active = False
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        param_rows = (len(args) if args else 0) if many else 1
+        rows_sent = sql_rows_sent(query, param_rows)
+        sql_stats.record(template, elapsed_ms, rows_sent, self.rowcount)
+        if elapsed_ms >= SLOW_QUERY_MS and sql_stats.note_slow(template):
+            # executemany は先頭行のパラメータで EXPLAIN する
+            explain_args = (args[0] if args else None) if many else args
+            self._capture_slow(template, query, explain_args, elapsed_ms, rows_sent)
+        return result
+
+    def _capture_slow(self, template: str, query: str, args, elapsed_ms: float, rows_sent: Optional[int]) -> None:
+        item: Dict[str, Any] = {
+            "at_ms": int(time.time() * 1000),
+            "sql": template if len(template) <= 2000 else template[:2000] + "...",
+            "elapsed_ms": round(elapsed_ms, 3),
+        }
+        if rows_sent is None:
+            item["rows_returned"] = self.rowcount
+        else:
+            item["rows_sent"] = rows_sent
+            item["rows_affected"] = self.rowcount
+        try:
+            with self.connection.cursor(pymysql.cursors.DictCursor) as cur:
+                # SHOW WARNINGS は直前の文に対するものなので EXPLAIN より先に取る
+                cur.execute("SHOW WARNINGS")
+                item["warnings"] = list(cur.fetchall())
+                cur.execute("EXPLAIN " + self.mogrify(query, args))
+                item["explain"] = list(cur.fetchall())
+        except Exception as e:
+            item["capture_error"] = str(e)
+        sql_stats.add_slow(json.loads(json.dumps(item, default=str)))
+
 def get_conn():
     return pymysql.connect(
         host=MYSQL_HOST,
@@ -233,27 +478,374 @@ def get_conn():
         password=MYSQL_PASS,
         database=MYSQL_DB,
         charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor,
+        cursorclass=InstrumentedCursor,
         autocommit=True,
     )
 
-def fetch_google_search_cache_flag() -> str:
-    sql = "SELECT flg FROM google_search_cache_flg LIMIT 1"
-    try:
+# レプリカを「落ちている」とみなすサーバ側エラー（接続数超過・認証・ホスト拒否・シャットダウン・通信断など）。
+# 2000 番台のクライアントエラー（接続不可・切断）と InterfaceError も同様に扱う
+REPLICA_CONNECTION_ERROR_CODES = {1040, 1043, 1044, 1045, 1053, 1129, 1130, 1152, 1158, 1159, 1160, 1161, 1927}
+
+def is_connection_error(error: Exception) -> bool:
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    if not isinstance(error, pymysql.err.OperationalError):
+        return False
+    code = error.args[0] if error.args else None
+    return isinstance(code, int) and (2000 <= code < 3000 or code in REPLICA_CONNECTION_ERROR_CODES)
+
+class ReplicaRouter:
+    """
+    参照系クエリを read replica のコネクションプールで実行する。
+    レプリカ未設定・遅延が REPLICA_MAX_LAG_S 超または不明・接続エラーのときはプライマリ（get_conn）で実行する。
+    接続エラー後 REPLICA_RETRY_AFTER_S 秒はレプリカを使わない。クエリ自体のエラーはそのまま送出する。
+    """
+    def __init__(self, host: str, port: int, user: str, password: str):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._lag_s: Optional[float] = None
+        self._lag_checked_at = 0.0
+        self._down_until = 0.0
+        self.last_error: Optional[str] = None
+        self.lag_error: Optional[str] = None
+        self.counters = {"replica": 0, "primary": 0, "fallback": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.host)
+
+    def _connect(self):
+        return pymysql.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=MYSQL_DB,
+            charset="utf8mb4",
+            cursorclass=InstrumentedCursor,
+            autocommit=True,
+            init_command="SET SESSION TRANSACTION READ ONLY",
+        )
+
+    def _acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                # wait_timeout で切られている可能性があるので、長く寝ていたものは作り直す
+                if now - released_at < REPLICA_POOL_RECYCLE_S and conn.open:
+                    return conn
+                self._close(conn)
+        return self._connect()
+
+    def _release(self, conn, reusable: bool) -> None:
+        if reusable and conn.open:
+            with self._lock:
+                if len(self._idle) < REPLICA_POOL_SIZE:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        self._close(conn)
+
+    def _close(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard_idle(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _fetch_lag(self, conn) -> Optional[float]:
+        with conn.cursor() as cur:
+            if REPLICA_LAG_QUERY:
+                # pt-heartbeat などのハートビート表。REPLICATION CLIENT 権限なしで遅延を測れる
+                cur.execute(REPLICA_LAG_QUERY)
+                row = cur.fetchone()
+                value = next(iter(row.values())) if row else None
+                return None if value is None else float(value)
+            try:
+                cur.execute("SHOW REPLICA STATUS")
+            except pymysql.err.ProgrammingError:
+                cur.execute("SHOW SLAVE STATUS")
+            row = cur.fetchone()
+        if not row:
+            # レプリケーションが未設定・リセット済みのホスト。データが古い可能性があるので遅延不明として扱う
+            return 0.0 if REPLICA_ASSUME_NO_LAG else None
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        return None if lag is None else float(lag)
+
+    def _lag_ok(self, conn) -> bool:
+        now = time.monotonic()
+        if now - self._lag_checked_at >= REPLICA_LAG_CHECK_TTL_S:
+            try:
+                self._lag_s = self._fetch_lag(conn)
+                self.lag_error = None
+            except pymysql.err.MySQLError as e:
+                if is_connection_error(e):
+                    raise
+                # 権限不足（1227 など）は遅延不明として扱う。レプリカを落ちている扱いにはしない
+                self._lag_s = None
+                self.lag_error = str(e)
+            self._lag_checked_at = now
+        return self._lag_s is not None and self._lag_s <= REPLICA_MAX_LAG_S
+
+    def run(self, fn: Callable[[Any], Any]) -> Any:
+        """fn(conn) をレプリカ（使えなければプライマリ）で実行して結果を返す。"""
+        if self.enabled and time.monotonic() >= self._down_until:
+            conn = None
+            try:
+                conn = self._acquire()
+                if self._lag_ok(conn):
+                    result = fn(conn)
+                    self._release(conn, True)
+                    self.counters["replica"] += 1
+                    return result
+                self._release(conn, True)
+            except pymysql.err.MySQLError as e:
+                if conn is not None:
+                    self._release(conn, not is_connection_error(e))
+                if not is_connection_error(e):
+                    raise
+                self.last_error = str(e)
+                self._down_until = time.monotonic() + REPLICA_RETRY_AFTER_S
+                self._discard_idle()
+            except Exception:
+                if conn is not None:
+                    self._release(conn, False)
+                raise
+            self.counters["fallback"] += 1
+        else:
+            self.counters["primary"] += 1
+
         conn = get_conn()
+        try:
+            return fn(conn)
+        finally:
+            self._close(conn)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            idle = len(self._idle)
+        return {
+            "enabled": self.enabled,
+            "host": self.host or None,
+            "lag_s": self._lag_s,
+            "lag_error": self.lag_error,
+            "lag_query": REPLICA_LAG_QUERY or "SHOW REPLICA STATUS",
+            "assume_no_lag": REPLICA_ASSUME_NO_LAG,
+            "max_lag_s": REPLICA_MAX_LAG_S,
+            "down_for_s": max(0.0, round(self._down_until - time.monotonic(), 3)),
+            "last_error": self.last_error,
+            "idle_connections": idle,
+            "counters": dict(self.counters),
+            "pid": os.getpid(),
+        }
+
+replica_router = ReplicaRouter(MYSQL_REPLICA_HOST, MYSQL_REPLICA_PORT, MYSQL_REPLICA_USER, MYSQL_REPLICA_PASS)
+
+def run_read_query(fn: Callable[[Any], Any]) -> Any:
+    """参照専用の処理 fn(conn) を read replica 優先で実行する。書き込みは get_conn() を使うこと。"""
+    return replica_router.run(fn)
+
+class SharedValueCache:
+    """
+    SHARED_DIR（通常 tmpfs）上のファイルに JSON で値を置き、全ワーカーで共有する TTL 付きキャッシュ。
+    期限切れ時は flock で1ワーカーだけが loader を呼び、他のワーカーはその結果を読む。
+    SHARED_DIR が使えない場合は共有せず、毎回 loader を呼ぶ。
+    """
+    def __init__(self, shared_dir: str, ttl_s: float):
+        self.shared_dir = shared_dir
+        self.ttl_s = ttl_s
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.shared_dir, f"cache-{name}.json")
+
+    def _read_entry(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                entry = json.load(handle)
+            if isinstance(entry, dict) and "at" in entry and "value" in entry:
+                return entry
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _read_fresh(self, path: str):
+        entry = self._read_entry(path)
+        if entry is not None and time.time() - entry["at"] < self.ttl_s:
+            return True, entry["value"]
+        return False, None
+
+    def _write(self, path: str, value: Any) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(self.shared_dir, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as handle:
+            json.dump({"at": time.time(), "value": value}, handle, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def get(self, name: str, loader):
+        path = self._path(name)
+        found, value = self._read_fresh(path)
+        if found:
+            return value
+        try:
+            os.makedirs(self.shared_dir, exist_ok=True)
+            lock = open(path + ".lock", "a")
+        except OSError:
+            return loader()
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                found, value = self._read_fresh(path)
+                if found:
+                    return value
+                value = loader()
+                self.set(name, value)
+                return value
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def set(self, name: str, value: Any) -> None:
+        try:
+            self._write(self._path(name), value)
+        except OSError:
+            pass
+
+    def update(self, name: str, fn: Callable[[Any], Any]) -> Any:
+        """
+        flock の中で現在値（TTL は見ない。無ければ None）を fn に渡し、戻り値を保存して返す。
+        SHARED_DIR が使えない場合は OSError を送出する（呼び出し側でプロセス内の値を使う）。
+        """
+        path = self._path(name)
+        os.makedirs(self.shared_dir, exist_ok=True)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entry = self._read_entry(path)
+                value = fn(None if entry is None else entry["value"])
+                self._write(path, value)
+                return value
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def peek(self, name: str) -> Any:
+        """TTL に関係なく現在値を返す（無ければ None）。"""
+        entry = self._read_entry(self._path(name))
+        return None if entry is None else entry["value"]
+
+    def prune(self, prefix: str, max_idle_s: float) -> None:
+        """max_idle_s 以上更新されていない prefix の値を消す。"""
+        cutoff = time.time() - max_idle_s
+        for path in glob.glob(os.path.join(self.shared_dir, f"cache-{prefix}*.json")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    os.remove(path + ".lock")
+            except OSError:
+                pass
+
+class JancodeMstSnapshot:
+    """
+    jancode マスタを検証・圧縮した JSON を SHARED_DIR に1度だけ書き出し、各ワーカーは mmap で読む。
+    元ファイルの mtime/size が変わったら作り直す。ページキャッシュを共有するのでワーカー数に比例してメモリは増えない。
+    SHARED_DIR が使えない場合は、元ファイルを毎回読んで返す（従来の動作）。
+    """
+    def __init__(self, source_path: str, shared_dir: str):
+        self.source_path = source_path
+        self.shared_dir = shared_dir
+        self._lock = threading.Lock()
+        self._key: Optional[str] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self.last_error: Optional[str] = None
+
+    def _source_key(self) -> str:
+        st = os.stat(self.source_path)
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+    def _read_compact(self) -> bytes:
+        with open(self.source_path, "r", encoding="utf-8") as handle:
+            data = json.load(handle)
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def _build(self, path: str) -> None:
+        payload = self._read_compact()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as handle:
+            handle.write(payload)
+        os.replace(tmp, path)
+        # 古いスナップショットは unlink のみ（他ワーカーの mmap はそのまま有効）
+        for old in glob.glob(os.path.join(self.shared_dir, "jancode-mst-*.json")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def get(self):
+        """mmap（共有できないときは bytes）を返す。FileNotFoundError / json.JSONDecodeError はそのまま送出する。"""
+        key = self._source_key()
+        if key == self._key and self._mmap is not None:
+            return self._mmap
+        with self._lock:
+            if key != self._key or self._mmap is None:
+                try:
+                    self._mmap = self._map_snapshot(key)
+                except OSError as e:
+                    # SHARED_DIR が作れない・書けない場合。元ファイル自体のエラーは _read_compact から送出される
+                    self.last_error = str(e)
+                    return self._read_compact()
+                self._key = key
+                self.last_error = None
+            return self._mmap
+
+    def _map_snapshot(self, key: str) -> mmap.mmap:
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, f"jancode-mst-{key}.json")
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    self._build(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        try:
+            os.remove(path + ".lock")
+        except OSError:
+            pass
+        with open(path, "rb") as handle:
+            # 配信中のレスポンスが参照している可能性があるので古い mmap は閉じない
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+shared_cache = SharedValueCache(SHARED_DIR, SHARED_CACHE_TTL_S)
+crawl_stats_store = SharedValueCache(SHARED_DIR, CRAWL_STATS_MAX_IDLE_S)
+jancode_mst_snapshot = JancodeMstSnapshot(JANCODE_MST_PATH, SHARED_DIR)
+
+def _query_google_search_cache_flag() -> Optional[str]:
+    sql = "SELECT flg FROM google_search_cache_flg LIMIT 1"
+
+    def query(conn) -> Optional[str]:
         with conn.cursor() as cur:
             cur.execute(sql)
             row = cur.fetchone()
             if row and row.get("flg") is not None:
                 return str(row["flg"])
+            return None
+
+    return run_read_query(query)
+
+def fetch_google_search_cache_flag() -> str:
+    try:
+        value = shared_cache.get("google_search_cache_flg", _query_google_search_cache_flag)
     except Exception:
-        pass
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
-    return GOOGLE_SEARCH_CACHE_FLG
+        value = None
+    return value if value is not None else GOOGLE_SEARCH_CACHE_FLG
 
 def save_google_search_cache_flag(value: str) -> None:
     update_sql = "UPDATE google_search_cache_flg SET flg=%s"
@@ -269,6 +861,91 @@ def save_google_search_cache_flag(value: str) -> None:
             conn.close()
         except Exception:
             pass
+    shared_cache.set("google_search_cache_flg", value)
+
+def ping_db() -> None:
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+            cur.fetchone()
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def check_shared_dir() -> None:
+    """SHARED_DIR を作成し書き込めるか確認する。使えなくても各キャッシュは共有なしで動く。"""
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    if not os.access(SHARED_DIR, os.W_OK | os.X_OK):
+        raise PermissionError(f"shared dir is not writable: {SHARED_DIR}")
+
+# 起動時に並列で温めるもの。失敗しても起動は続け、エラーは /ready に出す
+# "db" は疎通確認のみ。プライマリはリクエストごとに接続するので、接続を温めておくことはしない
+WARM_UP_TASKS: Dict[str, Callable[[], Any]] = {
+    "shared_dir": check_shared_dir,
+    "db": ping_db,
+    "jancode_mst": lambda: jancode_mst_snapshot.get(),
+    # fetch_google_search_cache_flag() は例外を握りつぶすので、失敗が見えるよう直接読む
+    "google_search_cache_flg": lambda: shared_cache.get("google_search_cache_flg", _query_google_search_cache_flag),
+}
+if replica_router.enabled:
+    # レプリカのプールと遅延チェックを温める（使えなければプライマリで実行されるだけ）
+    WARM_UP_TASKS["db_replica"] = lambda: replica_router.run(lambda conn: None)
+
+startup_state: Dict[str, Any] = {
+    "warm": False,
+    "phases_ms": {
+        "imports": round((_IMPORTS_DONE - _MODULE_STARTED) * 1000, 3),
+        "load_dotenv": round((_DOTENV_DONE - _IMPORTS_DONE) * 1000, 3),
+    },
+    "errors": {},
+}
+_db_check_lock = threading.Lock()
+_db_check: Dict[str, Any] = {"at": 0.0, "ok": False, "error": None}
+
+def _run_warm_up_task(name: str, task: Callable[[], Any]) -> None:
+    started = time.perf_counter()
+    try:
+        task()
+    except Exception as e:
+        startup_state["errors"][name] = str(e)
+    startup_state["phases_ms"][f"warm_up.{name}"] = round((time.perf_counter() - started) * 1000, 3)
+
+def warm_up() -> None:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(WARM_UP_TASKS)) as executor:
+        for name, task in WARM_UP_TASKS.items():
+            executor.submit(_run_warm_up_task, name, task)
+    startup_state["phases_ms"]["warm_up"] = round((time.perf_counter() - started) * 1000, 3)
+    startup_state["phases_ms"]["total"] = round((time.perf_counter() - _MODULE_STARTED) * 1000, 3)
+    with _db_check_lock:
+        _db_check.update(at=time.monotonic(), ok="db" not in startup_state["errors"],
+                         error=startup_state["errors"].get("db"))
+    startup_state["warm"] = True
+    startup_logger.info(json.dumps({
+        "pid": os.getpid(),
+        "phases_ms": startup_state["phases_ms"],
+        "errors": startup_state["errors"],
+    }, ensure_ascii=False))
+
+def start_warm_up() -> None:
+    # 待たずに起動を続け、温まるまでは /ready が 503 を返す
+    threading.Thread(target=warm_up, name="mapcamera-warm-up", daemon=True).start()
+
+def check_db_ready() -> Tuple[bool, Optional[str]]:
+    """DB 疎通を確認する。プローブが DB を叩きすぎないよう READY_DB_CHECK_TTL_S 秒は結果を使い回す。"""
+    with _db_check_lock:
+        if time.monotonic() - _db_check["at"] < READY_DB_CHECK_TTL_S:
+            return _db_check["ok"], _db_check["error"]
+        try:
+            ping_db()
+            ok, error = True, None
+        except Exception as e:
+            ok, error = False, str(e)
+        _db_check.update(at=time.monotonic(), ok=ok, error=error)
+        return ok, error
 
 def require_asin_auth(credentials: HTTPBasicCredentials):
     if not ASIN_AUTH_USER or not ASIN_AUTH_PASS:
@@ -303,6 +980,332 @@ def _to_json_or_text(value: Any):
     # その他は文字列化
     return (None, str(value))
 
+# page_url ごとの変化間隔（EWMA）と最後に変化を観測した時刻。
+# ワーカー間で共有しないと各ワーカーが変化の 1/N しか見ず間隔を N 倍に見積もるので、crawl_stats_store に置く。
+# SHARED_DIR が使えない場合だけプロセス内（_crawl_stats）で保持する。
+_crawl_stats: Dict[str, Dict[str, Optional[float]]] = {}
+_crawl_lock = threading.Lock()
+_crawl_updates = 0
+
+def _crawl_key(page_url: str) -> str:
+    return page_url.split("#", 1)[0]
+
+def _crawl_store_name(key: str) -> str:
+    return "crawl-" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _recommend_crawl_delay(stat: Dict[str, Optional[float]], now_ms: int) -> int:
+    """
+    変化間隔の推定値あたり CRAWL_POLLS_PER_CHANGE 回ポーリングする間隔を返す。
+    最後の変化（変化を見ていなければ初回観測）から推定値以上経っている場合は、その経過時間を変化間隔とみなす。
+    """
+    since = stat.get("last_change_ms")
+    if since is None:
+        since = stat.get("first_seen_ms", now_ms)
+    quiet = max(0, now_ms - since)
+    ewma = stat.get("ewma_interval_ms")
+    expected = quiet if ewma is None else max(ewma, quiet)
+    if expected <= 0:
+        return CRAWL_DEFAULT_DELAY_MS
+    delay = int(expected / CRAWL_POLLS_PER_CHANGE)
+    return max(CRAWL_MIN_DELAY_MS, min(CRAWL_MAX_DELAY_MS, delay))
+
+def _apply_crawl_observations(
+    stat: Optional[Dict[str, Optional[float]]], observations: List[Tuple[int, bool]]
+) -> Dict[str, Optional[float]]:
+    for observed_ms, changed in observations:
+        if stat is None:
+            stat = {"first_seen_ms": observed_ms, "last_change_ms": None, "ewma_interval_ms": None}
+        stat["first_seen_ms"] = min(stat["first_seen_ms"], observed_ms)
+        if changed:
+            last_change = stat["last_change_ms"]
+            if last_change is not None and observed_ms > last_change:
+                interval = observed_ms - last_change
+                ewma = stat["ewma_interval_ms"]
+                stat["ewma_interval_ms"] = (
+                    interval if ewma is None else CRAWL_EWMA_ALPHA * interval + (1 - CRAWL_EWMA_ALPHA) * ewma
+                )
+            # クライアントの時刻はまとめ送信で前後するので、変化時刻は戻さない
+            stat["last_change_ms"] = observed_ms if last_change is None else max(last_change, observed_ms)
+    return stat
+
+def record_crawl_observations(page_url: Optional[str], observations: List[Tuple[int, bool]]) -> int:
+    """
+    ページ読み込みごとの観測 (時刻ms, 変化ありか) を page_url ごとに記録し、次回リロードまでの推奨待ち時間を返す。
+    新しい docs が無いページ読み込み（空の docs）も変化なしの観測として記録する。
+    """
+    global _crawl_updates
+    if not page_url or not observations:
+        return CRAWL_DEFAULT_DELAY_MS
+    key = _crawl_key(page_url)
+    observations = sorted(observations)
+    try:
+        stat = crawl_stats_store.update(
+            _crawl_store_name(key), lambda current: _apply_crawl_observations(current, observations)
+        )
+    except OSError:
+        with _crawl_lock:
+            stat = _apply_crawl_observations(_crawl_stats.pop(key, None), observations)
+            # 挿入順 = 最終参照順。上限を超えたら古いものから捨てる
+            _crawl_stats[key] = stat
+            while len(_crawl_stats) > CRAWL_MAX_TRACKED_URLS:
+                _crawl_stats.pop(next(iter(_crawl_stats)))
+    else:
+        _crawl_updates += 1
+        if _crawl_updates % 1000 == 0:
+            crawl_stats_store.prune("crawl-", CRAWL_STATS_MAX_IDLE_S)
+    return _recommend_crawl_delay(stat, observations[-1][0])
+
+def record_crawl_observation(page_url: Optional[str], observed_ms: int, changed: bool) -> int:
+    return record_crawl_observations(page_url, [(observed_ms, changed)])
+
+def record_crawl_polls(
+    page_url: Optional[str], polls: Optional[List["CrawlPollIn"]], observed_ms: int, changed: bool
+) -> int:
+    """
+    まとめ送信に含まれるページ読み込みごとの観測を記録し、最後の観測時点の推奨待ち時間を返す。
+    変化ありとみなすのは、DB に変化があり（changed）かつその読み込みで新しい docs を見たものだけ。
+    polls が無い（古いクライアント）場合は送信1回を1観測として扱う。
+    """
+    if not polls:
+        return record_crawl_observation(page_url, observed_ms, changed)
+    return record_crawl_observations(page_url, [(poll.ts, changed and poll.new_docs > 0) for poll in polls])
+
+def get_crawl_stat(page_url: str) -> Optional[Dict[str, Optional[float]]]:
+    key = _crawl_key(page_url)
+    with _crawl_lock:
+        if key in _crawl_stats:
+            return _crawl_stats[key]
+    return crawl_stats_store.peek(_crawl_store_name(key))
+
+class _NullTrace:
+    """トレース無効時に使う何もしないトレース。"""
+    def mark(self, span: str) -> None:
+        pass
+
+    def emit(self, **fields: Any) -> None:
+        pass
+
+_NULL_TRACE = _NullTrace()
+
+class RequestTrace:
+    """
+    1リクエスト内の区間ごとの所要時間(ms)を記録し、JSON 1行で trace_logger へ出力する。
+    mark(span) は直前の mark（または開始）からの経過時間を span として記録する。
+    started にはリクエスト受信時刻（RequestReceivedAtMiddleware）を渡す。無ければ生成時刻から測る。
+    """
+    def __init__(self, name: str, started: Optional[float] = None):
+        self.name = name
+        self.started = time.perf_counter() if started is None else started
+        self.last = self.started
+        self.spans: List[Tuple[str, float]] = []
+
+    def mark(self, span: str) -> None:
+        now = time.perf_counter()
+        self.spans.append((span, round((now - self.last) * 1000, 3)))
+        self.last = now
+
+    def emit(self, **fields: Any) -> None:
+        record = {
+            "trace": self.name,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "spans": dict(self.spans),
+        }
+        record.update(fields)
+        trace_logger.info(json.dumps(record, ensure_ascii=False))
+
+def start_trace(name: str, request: Optional[Request] = None):
+    """
+    トレースを開始する。request を渡すと受信時刻から測り、ハンドラ開始までを validate として記録する
+    （本文の受信・JSON パース・pydantic の検証、sync ハンドラのスレッド待ちを含む）。
+    """
+    if not TRACE_SPANS_ENABLED:
+        return _NULL_TRACE
+    received_at = getattr(request.state, "received_at", None) if request is not None else None
+    trace = RequestTrace(name, received_at)
+    if received_at is not None:
+        trace.mark("validate")
+    return trace
+
+class RequestReceivedAtMiddleware:
+    """リクエスト受信時刻を request.state.received_at に入れる（本文のパース・検証より前）。"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+app.add_middleware(RequestReceivedAtMiddleware)
+
+_profile_lock = threading.Lock()
+
+def _frame_label(frame) -> Tuple[str, str, int]:
+    code = frame.f_code
+    return (code.co_name, code.co_filename, frame.f_lineno)
+
+def sample_stacks(seconds: float, interval_s: float) -> Tuple[Counter, float]:
+    """
+    seconds 秒間、interval_s ごとに全スレッドのスタックを採取する（呼び出し元スレッドは除く）。
+    戻り値は (root→leaf のフレーム列 -> 出現回数, 実測秒数)。
+    """
+    own_id = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Counter = Counter()
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append((names.get(thread_id, str(thread_id)), "<thread>", 0))
+            counts[tuple(reversed(stack))] += 1
+        time.sleep(interval_s)
+    return counts, time.perf_counter() - started
+
+def to_collapsed(counts: Counter) -> str:
+    lines = []
+    for stack, n in counts.most_common():
+        names = [
+            name if filename == "<thread>" else f"{name} ({os.path.basename(filename)}:{line})"
+            for name, filename, line in stack
+        ]
+        lines.append(f"{';'.join(names)} {n}")
+    return "\n".join(lines) + "\n"
+
+def to_speedscope(counts: Counter, interval_s: float, elapsed_s: float) -> Dict[str, Any]:
+    frames: List[Dict[str, Any]] = []
+    index: Dict[Tuple[str, str, int], int] = {}
+    samples = []
+    weights = []
+    for stack, n in counts.items():
+        ids = []
+        for label in stack:
+            if label not in index:
+                index[label] = len(frames)
+                name, filename, line = label
+                frame_info: Dict[str, Any] = {"name": name}
+                if filename != "<thread>":
+                    frame_info["file"] = filename
+                    frame_info["line"] = line
+                frames.append(frame_info)
+            ids.append(index[label])
+        samples.append(ids)
+        weights.append(n * interval_s)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": "mapcamera worker",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": elapsed_s,
+                "samples": samples,
+                "weights": weights,
+            }
+        ],
+        "name": "mapcamera worker",
+        "exporter": "mapcamera-app",
+    }
+
+ASIN_RE = re.compile(r"^[A-Z0-9]{10}$")
+
+ASIN_UPLOAD_CSV_TYPES = ("text/csv", "text/plain", "application/csv", "application/vnd.ms-excel")
+
+def asin_upload_format(content_type: str) -> Optional[str]:
+    """Content-Type から "json" / "csv" を返す。対応していなければ None。"""
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if media_type == "application/json" or media_type.endswith("+json"):
+        return "json"
+    if media_type in ASIN_UPLOAD_CSV_TYPES:
+        return "csv"
+    return None
+
+def parse_asin_upload(body: bytes, upload_format: str) -> List[str]:
+    """
+    JSON（["B0...", ...] または {"asins": [...]}）か CSV（asin 列、なければ1列目）から ASIN 候補を取り出す。
+    upload_format は asin_upload_format() の戻り値。
+    """
+    text = body.decode("utf-8-sig")
+    if upload_format == "json":
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("asins")
+        if not isinstance(data, list):
+            raise ValueError("JSON must be a list of ASINs or {\"asins\": [...]}")
+        return [str(v) for v in data if v is not None]
+
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and any(c.strip() for c in row)]
+    if not rows:
+        return []
+    header = [c.strip().lower() for c in rows[0]]
+    column = 0
+    if "asin" in header:
+        column = header.index("asin")
+        rows = rows[1:]
+    return [row[column] if column < len(row) else "" for row in rows]
+
+def normalize_asins(values: List[str]) -> Tuple[List[str], List[str]]:
+    """正規化（前後空白除去・大文字化）・検証・重複排除を1パスで行い、(有効な ASIN, 不正な値) を返す。"""
+    seen = set()
+    valid: List[str] = []
+    rejected: List[str] = []
+    for value in values:
+        asin = value.strip().upper()
+        if not ASIN_RE.match(asin):
+            rejected.append(value)
+            continue
+        if asin in seen:
+            continue
+        seen.add(asin)
+        valid.append(asin)
+    return valid, rejected
+
+def bulk_upsert_asins(asins: List[str], now_ms: int) -> Tuple[int, int]:
+    """
+    ASIN_BULK_CHUNK_SIZE 件ずつ複数行 INSERT ... ON DUPLICATE KEY UPDATE を1トランザクションで実行し、
+    (inserted, updated) を返す。影響行数は新規=1, 更新=2 で数えられる。
+    """
+    inserted = 0
+    updated = 0
+    conn = get_conn()
+    try:
+        conn.begin()
+        with conn.cursor() as cur:
+            for start in range(0, len(asins), ASIN_BULK_CHUNK_SIZE):
+                chunk = asins[start:start + ASIN_BULK_CHUNK_SIZE]
+                sql = (
+                    "INSERT INTO asin_to_remember (asin, count, lastUpdateTime) VALUES "
+                    + ",".join(["(%s,%s,%s)"] * len(chunk))
+                    + " ON DUPLICATE KEY UPDATE count=VALUES(count), lastUpdateTime=VALUES(lastUpdateTime)"
+                )
+                params: List[Any] = []
+                for asin in chunk:
+                    params.extend((asin, 0, now_ms))
+                cur.execute(sql, params)
+                chunk_updated = max(0, min(len(chunk), cur.rowcount - len(chunk)))
+                updated += chunk_updated
+                inserted += len(chunk) - chunk_updated
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    return inserted, updated
+
 class LogItem(BaseModel):
     client_ts_ms: Optional[int] = None
     session_id: Optional[str] = Field(default=None, max_length=64)
@@ -358,11 +1361,17 @@ class MapCameraDoc(BaseModel):
     class Config:
         extra = "ignore"
 
+class CrawlPollIn(BaseModel):
+    ts: int
+    new_docs: int = 0
+
 class DocsIn(BaseModel):
     docs: List[MapCameraDoc]
     client_ts_ms: Optional[int] = None
     page_url: Optional[str] = None
     context: Optional[str] = Field(default=None, max_length=16)
+    # まとめ送信に含まれるページ読み込みごとの観測（時刻と新しい docs の件数）
+    polls: Optional[List[CrawlPollIn]] = None
 
 class DocDetailIn(BaseModel):
     jan: str = Field(..., max_length=20)
@@ -378,6 +1387,23 @@ class DocDetailIn(BaseModel):
 def health():
     return {"ok": True}
 
+@app.get("/ready")
+def ready():
+    warm = startup_state["warm"]
+    db_ok, db_error = check_db_ready() if warm else (False, None)
+    body = {
+        "ready": warm and db_ok,
+        "warm": warm,
+        "db": db_ok,
+        "db_error": db_error,
+        "startup_ms": dict(startup_state["phases_ms"]),
+        "warm_up_errors": dict(startup_state["errors"]),
+        "pid": os.getpid(),
+    }
+    if not body["ready"]:
+        return JSONResponse(body, status_code=503)
+    return body
+
 @app.get("/asin-to-remember", response_class=HTMLResponse)
 def asin_to_remember_form(credentials: HTTPBasicCredentials = Depends(basic_security)):
     require_asin_auth(credentials)
@@ -411,6 +1437,45 @@ def save_asin_to_remember(
         except Exception:
             pass
 
+@app.post("/asin-to-remember/bulk")
+async def save_asin_to_remember_bulk(
+    request: Request,
+    credentials: HTTPBasicCredentials = Depends(basic_security),
+):
+    require_asin_auth(credentials)
+    content_type = request.headers.get("content-type", "")
+    upload_format = asin_upload_format(content_type)
+    if upload_format is None:
+        raise HTTPException(
+            status_code=415,
+            detail=f"unsupported content-type {content_type!r}; use application/json or text/csv",
+        )
+    body = await request.body()
+    try:
+        values = parse_asin_upload(body, upload_format)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(values) > ASIN_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"too many ASINs (max {ASIN_BULK_MAX_ITEMS})")
+
+    asins, rejected = normalize_asins(values)
+    now_ms = int(time.time() * 1000)
+    inserted = updated = 0
+    if asins:
+        try:
+            inserted, updated = await run_in_threadpool(bulk_upsert_asins, asins, now_ms)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "received": len(values),
+        "unique": len(asins),
+        "inserted": inserted,
+        "updated": updated,
+        "rejected": len(rejected),
+        "rejected_samples": rejected[:100],
+        "lastUpdateTime": now_ms,
+    }
+
 @app.get("/google-search-cache-flag", response_class=HTMLResponse)
 def google_search_cache_form(credentials: HTTPBasicCredentials = Depends(basic_security)):
     require_asin_auth(credentials)
@@ -429,22 +1494,98 @@ def update_google_search_cache_flag(
         message="更新しました。",
     )
 
+@app.get("/admin/profile")
+def admin_profile(
+    seconds: float = 10,
+    interval_ms: float = 10,
+    format: str = "speedscope",
+    credentials: HTTPBasicCredentials = Depends(basic_security),
+):
+    require_asin_auth(credentials)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be in [1, 1000]")
+    if format not in ("speedscope", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be speedscope or collapsed")
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="profiler already running")
+    try:
+        interval_s = interval_ms / 1000
+        counts, elapsed = sample_stacks(seconds, interval_s)
+    finally:
+        _profile_lock.release()
+
+    filename = f"mapcamera-profile-{os.getpid()}-{int(time.time())}"
+    if format == "collapsed":
+        return PlainTextResponse(
+            to_collapsed(counts),
+            headers={"Content-Disposition": f'attachment; filename="{filename}.txt"'},
+        )
+    return JSONResponse(
+        to_speedscope(counts, interval_s, elapsed),
+        headers={"Content-Disposition": f'attachment; filename="{filename}.speedscope.json"'},
+    )
+
+@app.get("/admin/trace-spans")
+def get_trace_spans(credentials: HTTPBasicCredentials = Depends(basic_security)):
+    require_asin_auth(credentials)
+    return {"enabled": TRACE_SPANS_ENABLED, "pid": os.getpid()}
+
+@app.post("/admin/trace-spans")
+def set_trace_spans(
+    enabled: bool = Form(...),
+    credentials: HTTPBasicCredentials = Depends(basic_security),
+):
+    global TRACE_SPANS_ENABLED
+    require_asin_auth(credentials)
+    TRACE_SPANS_ENABLED = enabled
+    return {"enabled": TRACE_SPANS_ENABLED, "pid": os.getpid()}
+
+@app.get("/admin/sql-stats")
+def get_sql_stats(credentials: HTTPBasicCredentials = Depends(basic_security)):
+    require_asin_auth(credentials)
+    return sql_stats.snapshot()
+
+@app.get("/admin/db-routing")
+def get_db_routing(credentials: HTTPBasicCredentials = Depends(basic_security)):
+    require_asin_auth(credentials)
+    return replica_router.status()
+
+@app.post("/admin/sql-stats/reset")
+def reset_sql_stats(credentials: HTTPBasicCredentials = Depends(basic_security)):
+    require_asin_auth(credentials)
+    sql_stats.reset()
+    return {"ok": True, "pid": os.getpid()}
+
 @app.get("/mapcamera-jancode-mst")
 def get_jancode_mst(x_api_key: str = Header(default="")):
     if API_KEY and x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
     try:
-        with open(JANCODE_MST_PATH, "r", encoding="utf-8") as handle:
-            return json.load(handle)
+        snapshot = jancode_mst_snapshot.get()
     except FileNotFoundError as exc:
         raise HTTPException(status_code=404, detail="jancode mst not found") from exc
     except json.JSONDecodeError as exc:
         raise HTTPException(status_code=500, detail="invalid jancode mst json") from exc
 
+    def iter_chunks(chunk_size: int = 256 * 1024):
+        for start in range(0, len(snapshot), chunk_size):
+            yield snapshot[start:start + chunk_size]
+
+    return StreamingResponse(
+        iter_chunks(),
+        media_type="application/json",
+        headers={"Content-Length": str(len(snapshot))},
+    )
+
 @app.post("/ingest")
-def ingest(payload: BatchIn, x_api_key: str = Header(default="")):
+def ingest(payload: BatchIn, request: Request, x_api_key: str = Header(default="")):
+    trace = start_trace("ingest", request)
     if API_KEY and x_api_key != API_KEY:
+        trace.emit(status=401)
         raise HTTPException(status_code=401, detail="Unauthorized")
+    trace.mark("auth")
 
     rows = []
     for it in payload.items:
@@ -475,12 +1616,19 @@ def ingest(payload: BatchIn, x_api_key: str = Header(default="")):
      CAST(%s AS JSON), CAST(%s AS JSON), %s, %s)
     """
 
+    trace.mark("build_rows")
+
     try:
         conn = get_conn()
+        trace.mark("connect")
         with conn.cursor() as cur:
             cur.executemany(sql, rows)
+        trace.mark("execute")
+        trace.emit(rows=len(rows))
         return {"inserted": len(rows)}
     except Exception as e:
+        # 失敗やロック待ちで遅いリクエストほど見たいので、エラーでも出力する
+        trace.emit(rows=len(rows), status=500, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         try:
@@ -489,14 +1637,19 @@ def ingest(payload: BatchIn, x_api_key: str = Header(default="")):
             pass
 
 @app.post("/mapcamera-search-docs")
-def ingest_docs(payload: DocsIn, x_api_key: str = Header(default="")):
+def ingest_docs(payload: DocsIn, request: Request, x_api_key: str = Header(default="")):
+    trace = start_trace("ingest_docs", request)
     if API_KEY and x_api_key != API_KEY:
+        trace.emit(status=401, page_url=payload.page_url)
         raise HTTPException(status_code=401, detail="Unauthorized")
+    trace.mark("auth")
 
+    updatetime = payload.client_ts_ms or int(time.time() * 1000)
     if not payload.docs:
-        return {"inserted": 0}
+        delay_ms = record_crawl_polls(payload.page_url, payload.polls, updatetime, False)
+        trace.emit(rows=0, changed=False, page_url=payload.page_url)
+        return {"inserted": 0, "next_reload_delay_ms": delay_ms}
 
-    updatetime = payload.client_ts_ms or int(time.time() * 1000)
     rows = []
     for doc in payload.docs:
         rows.append((
@@ -771,12 +1924,23 @@ def ingest_docs(payload: DocsIn, x_api_key: str = Header(default="")):
      )
     """
 
+    trace.mark("build_rows")
+
     try:
         conn = get_conn()
+        trace.mark("connect")
         with conn.cursor() as cur:
             cur.executemany(sql, rows)
-        return {"inserted": len(rows)}
+            # 新規=1, 変更あり=2, 変更なし=0 の合計なので 0 より大きければページに変化あり
+            changed = cur.rowcount > 0
+        trace.mark("execute")
+        trace.emit(rows=len(rows), changed=changed, page_url=payload.page_url)
+        return {
+            "inserted": len(rows),
+            "next_reload_delay_ms": record_crawl_polls(payload.page_url, payload.polls, updatetime, changed),
+        }
     except Exception as e:
+        trace.emit(rows=len(rows), status=500, error=str(e), page_url=payload.page_url)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         try:
@@ -827,3 +1991,15 @@ def ingest_doc_detail(payload: DocDetailIn, x_api_key: str = Header(default=""))
             conn.close()
         except Exception:
             pass
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # MC_WORKERS > 1 でマルチプロセス起動。jancode マスタ・参照テーブル・リロード間隔の統計は SHARED_DIR 経由で共有される
+    uvicorn.run(
+        "app:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=os.environ.get("MC_HOST", "0.0.0.0"),
+        port=int(os.environ.get("MC_PORT", "8000")),
+        workers=WORKERS,
+    )
@@ -0,0 +1,457 @@
+import json
+import logging
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def crawl_stats_store(tmp_path, monkeypatch):
+    app._crawl_stats.clear()
+    store = app.SharedValueCache(str(tmp_path / "shm"), 60)
+    monkeypatch.setattr(app, "crawl_stats_store", store)
+    return store
+
+
+def test_crawl_delay_backs_off_while_page_is_unchanged():
+    url = "https://www.mapcamera.com/search?q=a"
+    assert app.record_crawl_observation(url, 1_000, False) == app.CRAWL_DEFAULT_DELAY_MS
+    assert app.record_crawl_observation(url, 61_000, False) == 15_000
+    assert app.record_crawl_observation(url, 10_000_000, False) == app.CRAWL_MAX_DELAY_MS
+
+
+def test_crawl_delay_follows_change_interval():
+    url = "https://www.mapcamera.com/search?q=b#top"
+    app.record_crawl_observation(url, 0, True)
+    assert app.record_crawl_observation(url, 40_000, True) == 10_000
+    # 変化が止まると経過時間に合わせて間隔を延ばす
+    assert app.record_crawl_observation(url, 440_000, False) == 100_000
+    assert app.get_crawl_stat("https://www.mapcamera.com/search?q=b")["last_change_ms"] == 40_000
+
+
+def test_crawl_change_time_does_not_move_backwards():
+    url = "https://www.mapcamera.com/search?q=c"
+    app.record_crawl_observation(url, 100_000, True)
+    app.record_crawl_observation(url, 90_000, True)
+    assert app.get_crawl_stat(url)["last_change_ms"] == 100_000
+    assert app.get_crawl_stat(url)["first_seen_ms"] == 90_000
+
+
+def test_crawl_stats_are_shared_between_workers(tmp_path, monkeypatch):
+    url = "https://www.mapcamera.com/search?q=w"
+    app.record_crawl_observation(url, 0, True)
+    # 別ワーカー = 同じ SHARED_DIR を見る別インスタンス
+    monkeypatch.setattr(app, "crawl_stats_store", app.SharedValueCache(str(tmp_path / "shm"), 60))
+    assert app.record_crawl_observation(url, 8_000, True) == 2_000
+    assert app._crawl_stats == {}
+
+
+def test_crawl_stats_fall_back_to_process_when_shared_dir_is_unusable(tmp_path, monkeypatch):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(app, "crawl_stats_store", app.SharedValueCache(str(blocker / "shm"), 60))
+    url = "https://www.mapcamera.com/search?q=f"
+    app.record_crawl_observation(url, 0, True)
+    assert app.record_crawl_observation(url, 8_000, True) == 2_000
+    assert app.get_crawl_stat(url) is app._crawl_stats[url]
+
+
+class _DocsCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def executemany(self, sql, rows):
+        self.rowcount = self.conn.rowcount
+
+
+class _DocsConn:
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+    def cursor(self):
+        return _DocsCursor(self)
+
+    def close(self):
+        pass
+
+
+def _post_docs(client, url, docs, polls):
+    res = client.post(
+        "/mapcamera-search-docs",
+        headers={"x-api-key": app.API_KEY},
+        json={"page_url": url, "client_ts_ms": polls[-1]["ts"], "docs": docs, "polls": polls},
+    )
+    assert res.status_code == 200
+    return res.json()["next_reload_delay_ms"]
+
+
+def test_ingest_docs_records_each_batched_page_load(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app.app)
+    url = "https://www.mapcamera.com/search?q=hot"
+    monkeypatch.setattr(app, "get_conn", lambda: _DocsConn(rowcount=30))
+    # 2 秒ごとのリロードで毎回変化しているページを 60 秒分まとめて送る
+    polls = [{"ts": 2_000 * i, "new_docs": 1} for i in range(1, 31)]
+    assert _post_docs(client, url, [{"genpin_id": 1}], polls) == app.CRAWL_MIN_DELAY_MS
+    assert app.get_crawl_stat(url)["ewma_interval_ms"] == 2_000
+
+    # DB に変化が無ければ new_docs があっても変化なしとして扱う
+    monkeypatch.setattr(app, "get_conn", lambda: _DocsConn(rowcount=0))
+    polls = [{"ts": 60_000 + 20_000 * i, "new_docs": 1} for i in range(1, 21)]
+    assert _post_docs(client, url, [{"genpin_id": 1}], polls) == 100_000
+    assert app.get_crawl_stat(url)["last_change_ms"] == 60_000
+
+
+def test_crawl_delay_without_page_url_is_default():
+    assert app.record_crawl_observation(None, 1_000, True) == app.CRAWL_DEFAULT_DELAY_MS
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_trace_spans_are_logged_when_enabled(monkeypatch):
+    handler = _ListHandler()
+    app.trace_logger.addHandler(handler)
+    try:
+        monkeypatch.setattr(app, "TRACE_SPANS_ENABLED", False)
+        app.start_trace("ingest").emit(rows=1)
+        assert handler.records == []
+
+        monkeypatch.setattr(app, "TRACE_SPANS_ENABLED", True)
+        trace = app.start_trace("ingest")
+        trace.mark("auth")
+        trace.mark("execute")
+        trace.emit(rows=3)
+    finally:
+        app.trace_logger.removeHandler(handler)
+
+    assert app.trace_logger.isEnabledFor(logging.INFO)
+    assert len(handler.records) == 1
+    record = json.loads(handler.records[0].getMessage())
+    assert record["trace"] == "ingest"
+    assert record["rows"] == 3
+    assert list(record["spans"]) == ["auth", "execute"]
+
+
+def test_trace_covers_validation_and_failed_requests(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    def refuse():
+        raise RuntimeError("lock wait timeout")
+
+    monkeypatch.setattr(app, "TRACE_SPANS_ENABLED", True)
+    monkeypatch.setattr(app, "get_conn", refuse)
+    handler = _ListHandler()
+    app.trace_logger.addHandler(handler)
+    try:
+        client = TestClient(app.app, raise_server_exceptions=False)
+        body = {"page_url": "https://www.mapcamera.com/search?q=t", "docs": [{"genpin_id": 1}]}
+        assert client.post("/mapcamera-search-docs", json=body, headers={"x-api-key": app.API_KEY}).status_code == 500
+        assert client.post("/mapcamera-search-docs", json=body, headers={"x-api-key": "wrong"}).status_code == 401
+    finally:
+        app.trace_logger.removeHandler(handler)
+
+    failed, unauthorized = [json.loads(r.getMessage()) for r in handler.records]
+    assert list(failed["spans"]) == ["validate", "auth", "build_rows"]
+    assert failed["status"] == 500 and failed["error"] == "lock wait timeout"
+    assert list(unauthorized["spans"]) == ["validate"] and unauthorized["status"] == 401
+
+
+def test_asin_upload_format_is_case_insensitive_and_strict():
+    assert app.asin_upload_format("Application/JSON; charset=utf-8") == "json"
+    assert app.asin_upload_format("text/CSV") == "csv"
+    assert app.asin_upload_format("text/plain") == "csv"
+    assert app.asin_upload_format("application/x-www-form-urlencoded") is None
+    assert app.asin_upload_format("") is None
+
+
+def test_parse_asin_upload_json():
+    assert app.parse_asin_upload(b'["B012345678", null, 1]', "json") == ["B012345678", "1"]
+    assert app.parse_asin_upload(b'{"asins": ["B012345678"]}', "json") == ["B012345678"]
+    with pytest.raises(ValueError):
+        app.parse_asin_upload(b'{"asin": "B012345678"}', "json")
+
+
+def test_parse_asin_upload_csv_uses_asin_column_or_first_column():
+    body = "\ufeffname,ASIN\nlens, b0abcdefgh \n\ncamera,B0ABCDEFGH\nshort\n".encode("utf-8")
+    assert app.parse_asin_upload(body, "csv") == [" b0abcdefgh ", "B0ABCDEFGH", ""]
+    assert app.parse_asin_upload(b"B012345678\nB012345679\n", "csv") == ["B012345678", "B012345679"]
+
+
+def test_normalize_asins_dedupes_and_rejects():
+    valid, rejected = app.normalize_asins([" b012345678", "B012345678", "bad", "B0123456789", "B0ABCDEFGH"])
+    assert valid == ["B012345678", "B0ABCDEFGH"]
+    assert rejected == ["bad", "B0123456789"]
+
+
+class _FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        rows = len(params) // 3
+        self.conn.statements.append((sql, rows))
+        # 先頭 existing 件は既存行（影響行数 2）、残りは新規（1）
+        updated = min(rows, self.conn.existing)
+        self.conn.existing -= updated
+        self.rowcount = rows + updated
+
+
+class _FakeConn:
+    def __init__(self, existing):
+        self.existing = existing
+        self.statements = []
+        self.committed = False
+        self.closed = False
+
+    def begin(self):
+        pass
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_bulk_upsert_asins_counts_inserted_and_updated(monkeypatch):
+    conn = _FakeConn(existing=3)
+    monkeypatch.setattr(app, "get_conn", lambda: conn)
+    monkeypatch.setattr(app, "ASIN_BULK_CHUNK_SIZE", 2)
+    asins = [f"B00000000{i}" for i in range(5)]
+
+    assert app.bulk_upsert_asins(asins, 123) == (2, 3)
+    assert [rows for _, rows in conn.statements] == [2, 2, 1]
+    assert conn.statements[0][0].count("(%s,%s,%s)") == 2
+    assert conn.committed and conn.closed
+
+
+def test_shared_caches_fall_back_when_shared_dir_is_unusable(tmp_path):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    source = tmp_path / "mst.json"
+    source.write_text('{"a": [1, 2]}', encoding="utf-8")
+
+    snapshot = app.JancodeMstSnapshot(str(source), str(blocker / "shm"))
+    assert bytes(snapshot.get()) == b'{"a":[1,2]}'
+    assert snapshot.last_error
+
+    cache = app.SharedValueCache(str(blocker / "shm"), 30)
+    assert cache.get("flag", lambda: "v1") == "v1"
+    cache.set("flag", "v2")
+    assert cache.get("flag", lambda: "v3") == "v3"
+
+
+def test_jancode_snapshot_is_shared_and_rebuilt_on_change(tmp_path):
+    source = tmp_path / "mst.json"
+    source.write_text('{"a": 1}', encoding="utf-8")
+    shm = tmp_path / "shm"
+
+    snapshot = app.JancodeMstSnapshot(str(source), str(shm))
+    assert snapshot.get()[:] == b'{"a":1}'
+    source.write_text('{"a": 22}', encoding="utf-8")
+    assert snapshot.get()[:] == b'{"a":22}'
+    assert len(list(shm.glob("jancode-mst-*.json"))) == 1
+
+
+def test_sql_template_folds_whitespace_and_value_groups():
+    assert app.sql_template("INSERT INTO t (a,b)\n  VALUES (%s,%s),(%s,%s),(%s,%s)\n ON DUPLICATE KEY UPDATE a=VALUES(a)") == (
+        "INSERT INTO t (a,b) VALUES (%s,%s),... ON DUPLICATE KEY UPDATE a=VALUES(a)"
+    )
+    assert app.sql_template("SELECT flg\n FROM google_search_cache_flg LIMIT 1") == (
+        "SELECT flg FROM google_search_cache_flg LIMIT 1"
+    )
+
+
+def test_sql_rows_sent_only_counts_dml():
+    assert app.sql_rows_sent("INSERT INTO t (a,b) VALUES (%s,%s),(%s,%s)", 1) == 2
+    assert app.sql_rows_sent("INSERT INTO t (a,b) VALUES (%s, CAST(%s AS JSON))", 5) == 5
+    assert app.sql_rows_sent("UPDATE google_search_cache_flg SET flg=%s", 1) == 1
+    assert app.sql_rows_sent("  delete from t where id=%s", 3) == 3
+    assert app.sql_rows_sent("SELECT flg FROM google_search_cache_flg LIMIT 1", 1) is None
+
+
+def test_slow_capture_is_rate_limited_per_template(monkeypatch):
+    stats = app.SqlStats(10)
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(app, "SLOW_QUERY_CAPTURE_INTERVAL_S", 60)
+
+    assert stats.note_slow("A")
+    assert not stats.note_slow("A")
+    assert stats.note_slow("B")
+    clock[0] += 61
+    assert stats.note_slow("A")
+    assert stats.stats["A"]["slow_calls"] == 3
+
+    stats.record("S", 1.0, None, 4)
+    stats.record("U", 1.0, 1, 1)
+    assert stats.stats["S"]["rows_returned"] == 4 and stats.stats["S"]["rows_affected"] == 0
+    assert stats.stats["U"]["rows_sent"] == 1 and stats.stats["U"]["rows_affected"] == 1
+
+
+def test_warm_up_records_phases_and_errors(monkeypatch):
+    def fail():
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(app, "WARM_UP_TASKS", {"ok": lambda: None, "db": fail})
+    monkeypatch.setattr(app, "startup_state", {"warm": False, "phases_ms": {}, "errors": {}})
+    handler = _ListHandler()
+    app.startup_logger.addHandler(handler)
+    try:
+        app.warm_up()
+    finally:
+        app.startup_logger.removeHandler(handler)
+
+    assert app.startup_state["warm"]
+    assert app.startup_state["errors"] == {"db": "db down"}
+    assert {"warm_up.ok", "warm_up.db", "warm_up", "total"} <= set(app.startup_state["phases_ms"])
+    assert app.check_db_ready() == (False, "db down")
+    assert json.loads(handler.records[0].getMessage())["errors"] == {"db": "db down"}
+
+
+class _ReplicaCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.query = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        self.query = query
+        if "STATUS" in query and self.conn.lag_error is not None:
+            raise self.conn.lag_error
+
+    def fetchone(self):
+        if "STATUS" in self.query:
+            return None if self.conn.lag is None else {"Seconds_Behind_Source": self.conn.lag}
+        return {"flg": self.conn.name}
+
+
+class _ReplicaConn:
+    open = True
+
+    def __init__(self, name, lag=0, lag_error=None):
+        self.name = name
+        self.lag = lag
+        self.lag_error = lag_error
+
+    def cursor(self):
+        return _ReplicaCursor(self)
+
+    def close(self):
+        self.open = False
+
+
+def _read_flag(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT flg FROM google_search_cache_flg LIMIT 1")
+        return cur.fetchone()["flg"]
+
+
+def _router(monkeypatch, replica_conn):
+    router = app.ReplicaRouter("replica", 3306, "u", "p")
+    monkeypatch.setattr(router, "_connect", lambda: replica_conn)
+    monkeypatch.setattr(app, "get_conn", lambda: _ReplicaConn("primary"))
+    return router
+
+
+def test_replica_router_uses_replica_and_falls_back_on_lag(monkeypatch):
+    replica = _ReplicaConn("replica", lag=0)
+    router = _router(monkeypatch, replica)
+    assert router.run(_read_flag) == "replica"
+    assert router.status()["idle_connections"] == 1
+
+    replica.lag = 999
+    router._lag_checked_at = 0
+    assert router.run(_read_flag) == "primary"
+    assert router.status()["counters"] == {"replica": 1, "primary": 0, "fallback": 1}
+
+
+def test_replica_router_query_errors_do_not_mark_replica_down(monkeypatch):
+    router = _router(monkeypatch, _ReplicaConn("replica"))
+
+    def bad_query(conn):
+        raise app.pymysql.err.ProgrammingError(1146, "Table doesn't exist")
+
+    with pytest.raises(app.pymysql.err.ProgrammingError):
+        router.run(bad_query)
+    assert router.status()["down_for_s"] == 0
+    assert router.run(_read_flag) == "replica"
+
+
+def test_replica_router_marks_down_on_connection_error(monkeypatch):
+    router = _router(monkeypatch, _ReplicaConn("replica"))
+
+    def refuse():
+        raise app.pymysql.err.OperationalError(2003, "Can't connect")
+
+    monkeypatch.setattr(router, "_connect", refuse)
+    assert router.run(_read_flag) == "primary"
+    assert router.status()["down_for_s"] > 0
+    assert router.run(_read_flag) == "primary"
+    assert router.status()["counters"] == {"replica": 0, "primary": 1, "fallback": 1}
+
+
+def test_replica_router_lag_probe_without_privilege_is_unknown_lag(monkeypatch):
+    denied = app.pymysql.err.OperationalError(1227, "Access denied; you need the REPLICATION CLIENT privilege")
+    router = _router(monkeypatch, _ReplicaConn("replica", lag_error=denied))
+    assert router.run(_read_flag) == "primary"
+    status = router.status()
+    assert status["down_for_s"] == 0
+    assert status["lag_s"] is None and "REPLICATION CLIENT" in status["lag_error"]
+    assert status["last_error"] is None
+
+
+def test_replica_router_without_replication_status_uses_primary(monkeypatch):
+    replica = _ReplicaConn("replica", lag=None)
+    router = _router(monkeypatch, replica)
+    assert router.run(_read_flag) == "primary"
+    assert router.status()["lag_s"] is None and router.status()["down_for_s"] == 0
+
+    # ローカル検証用に明示したときだけ遅延 0 とみなす
+    monkeypatch.setattr(app, "REPLICA_ASSUME_NO_LAG", True)
+    router._lag_checked_at = 0
+    assert router.run(_read_flag) == "replica"
+    assert router.status()["lag_s"] == 0.0
+
+
+def test_replica_router_lag_query_override(monkeypatch):
+    monkeypatch.setattr(app, "REPLICA_LAG_QUERY", "SELECT lag_s FROM heartbeat")
+    replica = _ReplicaConn("replica")
+    router = _router(monkeypatch, replica)
+    monkeypatch.setattr(_ReplicaCursor, "fetchone", lambda self: {"lag_s": 1.5} if "heartbeat" in self.query else {"flg": "replica"})
+    assert router.run(_read_flag) == "replica"
+    assert router.status()["lag_s"] == 1.5
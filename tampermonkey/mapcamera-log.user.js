@@ -1,11 +1,15 @@
 // ==UserScript==
 // @name         MapCamera ItemSearch Request+Response Logger + Auto Reload
 // @namespace    https://www.mapcamera.com/
-// @version      1.5.1
+// @version      1.7.4
 // @description  Log request/response for MapCamera itemsearch API calls and auto-reload after first response
 // @match        https://www.mapcamera.com/*
 // @run-at       document-start
 // @grant GM_xmlhttpRequest
+// @grant GM_getValue
+// @grant GM_setValue
+// @grant GM_deleteValue
+// @grant GM_listValues
 // @connect camiiira.com
 // ==/UserScript==
 
@@ -24,12 +28,47 @@
   const DOCS_INGEST_URL = "http://camiiira.com/mapcamera-search-docs";
   const DOCS_INGEST_API_KEY = "golden";
   const DOCS_INGEST_GENPIN_KEY = "__mc_genpin_ids_v1";
+
+  // ---- Docs buffering ----
+  // レスポンスごとに POST せず、GM storage に貯めてまとめて送る（リロードを跨いで保持）
+  // GM storage はタブ間で非同期に同期されるので、1つの値を読み書きすると他タブの追加分を上書きしてしまう。
+  // doc（genpin id）ごと・ページ読み込みごとに別のキーへ書き、送信時に一覧して集める
+  const DOCS_ENTRY_PREFIX = "__mc_docs_entry_v1:";
+  const DOCS_POLL_PREFIX = "__mc_docs_poll_v1:";
+  const DOCS_RETRY_KEY = "__mc_docs_retry_v1";
+  const TAB_ID_KEY = "__mc_tab_id_v1";
+  const DOCS_FLUSH_LOCK_KEY = "__mc_docs_flush_lock_v1";
+
+  // バッファがこの件数に達したら送信
+  const DOCS_FLUSH_MAX_DOCS = 500;
+
+  // 最も古いバッファがこの時間を超えたら送信
+  const DOCS_FLUSH_MAX_AGE_MS = 60_000;
+
+  // 1回の POST のタイムアウト（応答が無いままリロードが止まらないように）
+  const DOCS_POST_TIMEOUT_MS = 15_000;
+
+  // 他タブの送信中ロックを無視するまでの時間（送信失敗でロックが残った場合の保険）
+  // 送信グループごとに更新するので DOCS_POST_TIMEOUT_MS より長ければよい
+  const DOCS_FLUSH_LOCK_TTL_MS = 30_000;
+
+  // 送信失敗時の再送待ち（失敗が続くたびに倍にし、上限で止める）
+  const DOCS_RETRY_BASE_MS = 10_000;
+  const DOCS_RETRY_MAX_MS = 10 * 60 * 1000;
+
   // ---- Auto reload controls ----
   const ENABLE_AUTO_RELOAD = true;
 
-  // 「最初のレスポンスをログしたら」何秒後にリロードするか
+  // 「最初のレスポンスをログしたら」何秒後にリロードするか（サーバの推奨値が無い場合）
   const RELOAD_DELAY_MS = 2000;
 
+  // サーバ（docs ingest のレスポンス）が返す page_url ごとの推奨リロード間隔を使うか
+  const USE_SERVER_RELOAD_DELAY = true;
+  const RELOAD_DELAY_KEY = "__mc_reload_delay_v1";
+
+  // サーバ推奨値を信用する期間（古くなったら RELOAD_DELAY_MS に戻す）
+  const SERVER_RELOAD_DELAY_TTL_MS = 6 * 60 * 60 * 1000;
+
   // リロードの最短間隔（短すぎると負荷＆制限の原因になりやすい）
   const MIN_RELOAD_INTERVAL_MS = 1000;
 
@@ -88,6 +127,56 @@
     }
   };
 
+  // ページ読み込みごとの poll キーをタブ間で衝突させないための id
+  const loadTabId = () => {
+    try {
+      let tabId = sessionStorage.getItem(TAB_ID_KEY);
+      if (!tabId) {
+        tabId = Math.random().toString(36).slice(2, 10);
+        sessionStorage.setItem(TAB_ID_KEY, tabId);
+      }
+      return tabId;
+    } catch {
+      return Math.random().toString(36).slice(2, 10);
+    }
+  };
+
+  const pageKey = (url) => String(url ?? "").split("#")[0];
+
+  const loadReloadDelays = () => {
+    try {
+      const raw = GM_getValue(RELOAD_DELAY_KEY, "");
+      if (!raw) return {};
+      const parsed = JSON.parse(raw);
+      return parsed && typeof parsed === "object" ? parsed : {};
+    } catch {
+      return {};
+    }
+  };
+
+  const saveReloadDelay = (pageUrl, delayMs) => {
+    if (!Number.isFinite(delayMs) || delayMs <= 0) return;
+    try {
+      const delays = loadReloadDelays();
+      const t = now();
+      Object.keys(delays).forEach((key) => {
+        if (t - (delays[key]?.at ?? 0) > SERVER_RELOAD_DELAY_TTL_MS) delete delays[key];
+      });
+      delays[pageKey(pageUrl)] = { delayMs, at: t };
+      GM_setValue(RELOAD_DELAY_KEY, JSON.stringify(delays));
+    } catch {
+      // ignore
+    }
+  };
+
+  const currentReloadDelay = () => {
+    if (!USE_SERVER_RELOAD_DELAY) return RELOAD_DELAY_MS;
+    const entry = loadReloadDelays()[pageKey(location.href)];
+    if (!entry || !Number.isFinite(entry.delayMs)) return RELOAD_DELAY_MS;
+    if (now() - (entry.at ?? 0) > SERVER_RELOAD_DELAY_TTL_MS) return RELOAD_DELAY_MS;
+    return entry.delayMs;
+  };
+
   const extractGenpinId = (doc) => {
     if (!doc || typeof doc !== "object") return null;
     if (doc.genpinId != null) return String(doc.genpinId);
@@ -192,56 +281,266 @@
     return { ...meta, body: payload };
   };
 
-  const postDocs = async (docs, context) => {
-    if (!DOCS_INGEST_ENABLED) return;
-    if (!DOCS_INGEST_API_KEY) {
-      console.warn("[MapCamera][docs][skip] missing DOCS_INGEST_API_KEY");
-      return;
+  const readJsonValue = (key) => {
+    try {
+      const raw = GM_getValue(key, "");
+      return raw ? JSON.parse(raw) : null;
+    } catch {
+      return null;
+    }
+  };
+
+  const writeJsonValue = (key, value) => {
+    try {
+      GM_setValue(key, JSON.stringify(value));
+    } catch {
+      // ignore
+    }
+  };
+
+  const deleteValue = (key) => {
+    try {
+      GM_deleteValue(key);
+    } catch {
+      // ignore
     }
-    if (!Array.isArray(docs) || docs.length === 0) return;
+  };
+
+  const listKeys = (prefix) => {
+    try {
+      return GM_listValues().filter((key) => key.startsWith(prefix));
+    } catch {
+      return [];
+    }
+  };
+
+  // GM storage のキー -> バッファ済みの値（ts を持つもの）
+  const loadBuffered = (prefix) => {
+    const entries = {};
+    listKeys(prefix).forEach((key) => {
+      const entry = readJsonValue(key);
+      if (entry && Number.isFinite(entry.ts)) entries[key] = entry;
+    });
+    return entries;
+  };
+
+  const loadRetryState = () => {
+    const s = readJsonValue(DOCS_RETRY_KEY);
+    return {
+      failures: Number.isFinite(s?.failures) ? s.failures : 0,
+      retryAt: Number.isFinite(s?.retryAt) ? s.retryAt : 0,
+    };
+  };
+
+  // genpin id 単位で最新の doc だけを残す（id が無いものは内容で重複排除）
+  const docBufferKey = (doc) => {
+    const genpinId = extractGenpinId(doc);
+    if (genpinId) return `${DOCS_ENTRY_PREFIX}g:${genpinId}`;
+    return `${DOCS_ENTRY_PREFIX}j:${JSON.stringify(doc)}`;
+  };
+
+  let pollSeq = 0;
+
+  // 送信済み（2xx を受けた）genpin id はこのタブでは再送しない。未送信の doc は新しいレスポンスで上書きする
+  // 戻り値はバッファに無かった（または内容が変わった）doc の件数
+  const bufferDocs = (docs, context) => {
     const postedGenpinIds = loadPostedGenpinIds();
-    const docsToPost = docs.filter((doc) => {
+    const ts = now();
+    let newDocs = 0;
+    docs.forEach((doc) => {
       const genpinId = extractGenpinId(doc);
-      if (!genpinId) return true;
-      return !postedGenpinIds.has(genpinId);
+      if (genpinId && postedGenpinIds.has(genpinId)) return;
+      const key = docBufferKey(doc);
+      const current = readJsonValue(key);
+      if (current && JSON.stringify(current.doc) === JSON.stringify(doc)) return;
+      writeJsonValue(key, { doc, page_url: location.href, context, ts });
+      newDocs += 1;
+    });
+    // ページ読み込みごとの観測。新しい docs が無くても送り、サーバのリロード間隔の推定に使う
+    writeJsonValue(`${DOCS_POLL_PREFIX}${ts}:${loadTabId()}:${pollSeq++}`, {
+      page_url: location.href,
+      context,
+      ts,
+      new_docs: newDocs,
+    });
+    return newDocs;
+  };
+
+  // 送信に成功した分だけバッファから消し、送信済みとして記録する
+  // （送信中に同じ genpin id の新しい doc が入っていればそちらは残し、次回送る）
+  const removePostedDocs = (group) => {
+    const postedGenpinIds = loadPostedGenpinIds();
+    group.entries.forEach(([key, entry]) => {
+      const current = readJsonValue(key);
+      if (current && current.ts <= entry.ts) deleteValue(key);
+      const genpinId = extractGenpinId(entry.doc);
+      if (genpinId) postedGenpinIds.add(genpinId);
     });
-    if (docsToPost.length === 0) return;
+    savePostedGenpinIds(postedGenpinIds);
+    group.pollKeys.forEach((key) => deleteValue(key));
+    deleteValue(DOCS_RETRY_KEY);
+  };
+
+  const recordFlushFailure = () => {
+    const s = loadRetryState();
+    s.failures += 1;
+    s.retryAt = now() + Math.min(DOCS_RETRY_MAX_MS, DOCS_RETRY_BASE_MS * 2 ** (s.failures - 1));
+    writeJsonValue(DOCS_RETRY_KEY, s);
+    return s;
+  };
+
+  const shouldFlushDocs = () => {
+    const { retryAt } = loadRetryState();
+    if (retryAt && now() < retryAt) return false;
+    if (listKeys(DOCS_ENTRY_PREFIX).length >= DOCS_FLUSH_MAX_DOCS) return true;
+    const buffered = [
+      ...Object.values(loadBuffered(DOCS_ENTRY_PREFIX)),
+      ...Object.values(loadBuffered(DOCS_POLL_PREFIX)),
+    ];
+    if (buffered.length === 0) return false;
+    const oldestAt = Math.min(...buffered.map((entry) => entry.ts));
+    return now() - oldestAt >= DOCS_FLUSH_MAX_AGE_MS;
+  };
+
+  // 複数タブから同時に送信しないためのロック
+  const acquireFlushLock = () => {
     try {
-      await new Promise((resolve, reject) => {
-        GM_xmlhttpRequest({
-          method: "POST",
-          url: DOCS_INGEST_URL,
-          headers: {
-            "content-type": "application/json",
-            "x-api-key": DOCS_INGEST_API_KEY,
-          },
-          data: JSON.stringify({
-            client_ts_ms: Date.now(),
-            page_url: location.href,
-            context,
-            docs: docsToPost,
-          }),
-          onload: () => resolve(),
-          onerror: (err) => reject(err),
-          ontimeout: () => reject(new Error("timeout")),
-        });
+      const lockedAt = Number(GM_getValue(DOCS_FLUSH_LOCK_KEY, 0)) || 0;
+      if (lockedAt && now() - lockedAt < DOCS_FLUSH_LOCK_TTL_MS) return false;
+      GM_setValue(DOCS_FLUSH_LOCK_KEY, now());
+      return true;
+    } catch {
+      return false;
+    }
+  };
+
+  const releaseFlushLock = () => {
+    try {
+      GM_setValue(DOCS_FLUSH_LOCK_KEY, 0);
+    } catch {
+      // ignore
+    }
+  };
+
+  const postDocs = (group) =>
+    new Promise((resolve, reject) => {
+      GM_xmlhttpRequest({
+        method: "POST",
+        url: DOCS_INGEST_URL,
+        headers: {
+          "content-type": "application/json",
+          "x-api-key": DOCS_INGEST_API_KEY,
+        },
+        data: JSON.stringify({
+          client_ts_ms: group.ts,
+          page_url: group.page_url,
+          context: group.context,
+          docs: group.docs,
+          polls: group.polls.sort((a, b) => a.ts - b.ts),
+        }),
+        onload: (res) => {
+          if (res.status >= 200 && res.status < 300) resolve(res);
+          else reject(new Error(`status ${res.status}`));
+        },
+        timeout: DOCS_POST_TIMEOUT_MS,
+        onerror: (err) => reject(err),
+        ontimeout: () => reject(new Error("timeout")),
       });
-      console.log("[MapCamera][docs][posted]", {
-        context,
-        count: docsToPost.length,
+    });
+
+  let flushInFlight = null;
+
+  const flushDocs = async (reason) => {
+    if (!DOCS_INGEST_ENABLED) return;
+    if (!DOCS_INGEST_API_KEY) {
+      console.warn("[MapCamera][docs][skip] missing DOCS_INGEST_API_KEY");
+      return;
+    }
+    if (!acquireFlushLock()) return;
+    try {
+      // バッファは送信成功まで消さない（途中でページが閉じても次回のページで再送される）
+      const entries = loadBuffered(DOCS_ENTRY_PREFIX);
+      const polls = loadBuffered(DOCS_POLL_PREFIX);
+      if (Object.keys(entries).length === 0 && Object.keys(polls).length === 0) return;
+
+      // サーバ側は page_url 単位で扱うので、page_url ごとにまとめて送る
+      const groups = new Map();
+      const groupFor = (pageUrl, context) => {
+        const key = pageKey(pageUrl);
+        if (!groups.has(key)) {
+          groups.set(key, { page_url: pageUrl, context, ts: 0, entries: [], docs: [], pollKeys: [], polls: [] });
+        }
+        return groups.get(key);
+      };
+      Object.entries(entries).forEach(([key, entry]) => {
+        const g = groupFor(entry.page_url ?? null, entry.context);
+        g.entries.push([key, entry]);
+        g.docs.push(entry.doc);
+        g.ts = Math.max(g.ts, entry.ts);
       });
-      docsToPost.forEach((doc) => {
-        const genpinId = extractGenpinId(doc);
-        if (genpinId) postedGenpinIds.add(genpinId);
+      // ページ読み込みごとの観測を送る。新しい docs が無いページも空の docs で送る（サーバはリロード間隔の推定に使う）
+      Object.entries(polls).forEach(([key, poll]) => {
+        const g = groupFor(poll.page_url, poll.context);
+        g.pollKeys.push(key);
+        g.polls.push({ ts: poll.ts, new_docs: Number(poll.new_docs) || 0 });
+        // docs がある場合は変化を観測した時刻（= docs の時刻）を送る
+        if (g.docs.length === 0) g.ts = Math.max(g.ts, poll.ts);
       });
-      savePostedGenpinIds(postedGenpinIds);
-    } catch (e) {
-      console.warn("[MapCamera][docs][error]", String(e));
+
+      for (const g of groups.values()) {
+        try {
+          // 送信が長引いても他タブにロックを奪われないよう、グループごとに更新する
+          GM_setValue(DOCS_FLUSH_LOCK_KEY, now());
+          const res = await postDocs(g);
+          removePostedDocs(g);
+          const body = safeJsonParse(res.responseText ?? "");
+          const delayMs = Number(body?.next_reload_delay_ms);
+          if (g.page_url) saveReloadDelay(g.page_url, delayMs);
+          console.log("[MapCamera][docs][posted]", {
+            reason,
+            page_url: g.page_url,
+            count: g.docs.length,
+            nextReloadDelayMs: Number.isFinite(delayMs) ? delayMs : null,
+          });
+        } catch (e) {
+          // サーバ停止中に毎ページ全件を再送しないよう、残りは待ってから再送する
+          const b = recordFlushFailure();
+          console.warn("[MapCamera][docs][error]", String(e), {
+            failures: b.failures,
+            retryInMs: b.retryAt - now(),
+          });
+          break;
+        }
+      }
+    } finally {
+      releaseFlushLock();
     }
   };
+
+  const maybeFlushDocs = (reason) => {
+    if (flushInFlight) return flushInFlight;
+    if (!shouldFlushDocs()) return Promise.resolve();
+    flushInFlight = flushDocs(reason).finally(() => {
+      flushInFlight = null;
+    });
+    return flushInFlight;
+  };
+
   const handleDocs = async (docs, context) => {
-    if (!docs || docs.length === 0) return;
-    await postDocs(docs, context);
+    if (!docs) return;
+    const count = bufferDocs(docs, context);
+    if (count > 0) {
+      console.log("[MapCamera][docs][buffered]", { context, count });
+    }
+    await maybeFlushDocs("threshold");
+  };
+
+  // 送信中（または閾値超過で送信が必要）ならその完了を待ってからリロード
+  // （リロード間隔が長いページでも経過時間の閾値で送信されるように、ここでも判定する）
+  const reloadAfterFlush = () => {
+    maybeFlushDocs("reload")
+      .catch(() => {})
+      .finally(() => location.reload());
   };
 
   // ---- Auto reload trigger: "first response in this page load" ----
@@ -264,7 +563,7 @@
       console.log("[MapCamera][auto-reload] watchdog fired; reloading now", {
         timeoutMs: FORCE_RELOAD_TIMEOUT_MS,
       });
-      location.reload();
+      reloadAfterFlush();
     };
 
     watchdogId = setTimeout(arm, FORCE_RELOAD_TIMEOUT_MS);
@@ -302,7 +601,8 @@
       watchdogId = null;
     }
 
-    console.log("[MapCamera][auto-reload] scheduled", { reason, inMs: RELOAD_DELAY_MS });
+    const delayMs = currentReloadDelay();
+    console.log("[MapCamera][auto-reload] scheduled", { reason, inMs: delayMs });
 
     setTimeout(() => {
       const s2 = loadState();
@@ -311,8 +611,8 @@
       saveState(s2);
 
       console.log("[MapCamera][auto-reload] reloading now", s2);
-      location.reload();
-    }, RELOAD_DELAY_MS);
+      reloadAfterFlush();
+    }, delayMs);
   };
 
   // -------------------------
@@ -481,10 +781,16 @@
   console.log("[MapCamera] logger+auto-reload loaded", {
     ENABLE_AUTO_RELOAD,
     RELOAD_DELAY_MS,
+    currentReloadDelayMs: currentReloadDelay(),
     FORCE_RELOAD_TIMEOUT_MS,
     MIN_RELOAD_INTERVAL_MS,
     MAX_RELOADS_PER_TAB,
+    DOCS_FLUSH_MAX_DOCS,
+    DOCS_FLUSH_MAX_AGE_MS,
   });
 
+  // 前回までのページで貯まった分が閾値を超えていれば送信
+  void maybeFlushDocs("startup");
+
   scheduleWatchdog();
 })();